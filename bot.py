@@ -1,13 +1,21 @@
 import os
+import time
+import signal
+import asyncio
 import sqlite3
-from flask import Flask, make_response
-from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from aiohttp import web
 import discord
 from discord.ext import commands, tasks
-from datetime import datetime, timedelta
-from pytz import timezone
+from datetime import datetime
+from zoneinfo import ZoneInfo
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 
 # --- 1. Configuration & Setup ---
@@ -17,128 +25,282 @@ data_dir = os.getenv('RENDER_DATA_DIR', '.')
 os.makedirs(data_dir, exist_ok=True) # Ensure the directory exists
 db_path = os.path.join(data_dir, 'bot_data.db') # Path to your SQLite database file
 
-# Flask app to keep the bot alive (for web hosting services like Render)
-app = Flask('')
+# Define the timezone for all time-related operations (e.g., Philippines)
+ph_tz = ZoneInfo('Asia/Manila')
+
+# Time-tracking rules, defined once instead of being rebuilt on every check
+MAX_SHIFT_DURATION_SECONDS = 14 * 60 * 60 # Shifts longer than this (14 hours) are automatically clocked out
+CLOCK_IN_COOLDOWN_SECONDS = 5 * 60 # Minimum time (in seconds) between a clock-out and the next clock-in (adjustable)
+DISPLAY_TIME_FORMAT = "%I:%M %p on %B %d, %Y" # User-friendly format for times shown in Discord messages
 
-def run_flask_app():
-    """Runs the Flask web server."""
-    app.run(host='0.0.0.0', port=8080)
+def format_timestamp(dt):
+    """Formats a datetime as 'YYYY-MM-DD HH:MM:SS' (the format stored in the DB and Google Sheets)."""
+    # isoformat is implemented in C and avoids strftime's format-string parsing; drop the tzinfo so no UTC offset is appended
+    return dt.replace(tzinfo=None).isoformat(sep=' ', timespec='seconds')
 
-def keep_alive():
-    """Starts the Flask app in a separate thread."""
-    t = Thread(target=run_flask_app)
-    t.start()
+def parse_timestamp(timestamp_str):
+    """
+    Parses a 'YYYY-MM-DD HH:MM:SS' string produced by format_timestamp into a timezone-aware datetime.
+    fromisoformat is implemented in C (no strptime format parsing); raises ValueError if the string is malformed.
+    """
+    return datetime.fromisoformat(timestamp_str).replace(tzinfo=ph_tz)
 
-@app.route('/')
-def home():
+# Small aiohttp web app to keep the bot alive (for web hosting services like Render)
+# It runs on the bot's own event loop, so no extra thread or WSGI server is needed.
+app = web.Application()
+web_runner = None # Set once the web server has been started
+
+async def keep_alive():
+    """Starts the web server on the running event loop (only once it has started successfully, even if called again)."""
+    global web_runner
+    if web_runner is not None:
+        return
+    port = int(os.environ.get('PORT', 8080)) # Hosting platforms like Render provide the port to bind
+    print(f"Starting web server on port {port}")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host='0.0.0.0', port=port).start()
+    except OSError as e:
+        # e.g. the port is already in use; keep the bot running and try again on the next on_ready
+        print(f"ERROR: Failed to start web server on port {port}. Error: {e}")
+        await runner.cleanup()
+        return
+    web_runner = runner # Only mark the server as started once it is actually listening
+
+async def home(request):
     """Simple 'I'm alive!' endpoint for health checks."""
-    response = make_response("I'm alive!")
+    response = web.Response(text="I'm alive!")
     # Security headers (good practice)
     response.headers['X-Content-Type-Options'] = 'nosniff'
     response.headers['X-Frame-Options'] = 'DENY'
     response.headers['X-XSS-Protection'] = '1; mode=block'
     return response
 
+app.router.add_get('/', home)
+
 # --- 2. SQLite Database Functions ---
 
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row # Allows accessing columns by name
-    return conn
+# A single long-lived connection is shared by every helper below instead of connecting per call.
+# isolation_level=None puts the connection in autocommit mode, and the lock serializes access
+# because the connection may be used from more than one thread.
+db_conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+db_conn.row_factory = sqlite3.Row # Allows accessing columns by name
+db_lock = Lock()
 
-def init_db():
-    """Initializes database tables if they don't exist, and handles schema migrations."""
-    conn = get_db_connection()
-    c = conn.cursor()
-
-    # Create tables if they don't exist
-    c.execute('''CREATE TABLE IF NOT EXISTS excluded_users (user_id INTEGER PRIMARY KEY)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS active_shifts (user_id INTEGER PRIMARY KEY, clock_in TEXT, guild_id INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS last_clockouts (user_id INTEGER PRIMARY KEY, timestamp TEXT)''')
-
-    # --- Database Migration Logic ---
-    # This block ensures 'guild_id' column exists in 'active_shifts' table for new features.
-    # It adds the column without losing existing data if the table was created before this column was added.
-    try:
-        c.execute("SELECT guild_id FROM active_shifts LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Migrating active_shifts table: Adding 'guild_id' column...")
-        c.execute("ALTER TABLE active_shifts ADD COLUMN guild_id INTEGER")
-        conn.commit()
-        print("Migration complete. Existing active shifts will have NULL for guild_id until re-clocked.")
-    # --- End Migration Logic ---
+# Coroutines run the helpers below on this executor so disk I/O never blocks the event loop.
+# A single worker keeps writes in the order they were submitted.
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
 
-    conn.commit()
-    conn.close()
+async def run_db(func, *args):
+    """Runs a blocking database helper on the SQLite executor and returns its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args))
+
+def init_db():
+    """Tunes the connection, initializes database tables if they don't exist, and handles schema migrations."""
+    with db_lock:
+        c = db_conn.cursor()
+
+        # Tune the connection and create tables if they don't exist, all in one script
+        c.executescript('''
+            -- WAL journaling lets readers and the writer proceed concurrently, and synchronous=NORMAL
+            -- skips the fsync on every commit (WAL is still crash-safe, only the last commits may roll back)
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA busy_timeout=5000; -- Wait up to 5s instead of failing with "database is locked"
+            PRAGMA cache_size=-32000; -- ~32MB page cache, kept warm by the long-lived connection
+            PRAGMA temp_store=MEMORY; -- Keep temporary tables/indices in memory instead of temp files
+            PRAGMA mmap_size=67108864; -- Read the database file through a 64MB memory map instead of read() calls
+
+            CREATE TABLE IF NOT EXISTS excluded_users (user_id INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS active_shifts (user_id INTEGER PRIMARY KEY, clock_in TEXT, guild_id INTEGER, clock_in_ts INTEGER);
+            CREATE TABLE IF NOT EXISTS last_clockouts (user_id INTEGER PRIMARY KEY, timestamp TEXT, timestamp_ts INTEGER);
+            -- Rows waiting to be written to Google Sheets, oldest id first (the sheet is the only history of past shifts)
+            CREATE TABLE IF NOT EXISTS sheet_queue (id INTEGER PRIMARY KEY, user_name TEXT, action TEXT, timestamp TEXT);
+        ''')
+
+        # --- Database Migration Logic ---
+        # This block ensures 'guild_id' column exists in 'active_shifts' table for new features.
+        # It adds the column without losing existing data if the table was created before this column was added.
+        try:
+            c.execute("SELECT guild_id FROM active_shifts LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Migrating active_shifts table: Adding 'guild_id' column...")
+            c.execute("ALTER TABLE active_shifts ADD COLUMN guild_id INTEGER")
+            print("Migration complete. Existing active shifts will have NULL for guild_id until re-clocked.")
+
+        # This block adds 'clock_in_ts' (clock-in time as a Unix epoch) to 'active_shifts', so expiry checks
+        # are integer comparisons instead of re-parsing the 'clock_in' string on every run.
+        try:
+            c.execute("SELECT clock_in_ts FROM active_shifts LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Migrating active_shifts table: Adding 'clock_in_ts' column...")
+            # Add the column and backfill it in one transaction: if the process dies halfway, the column
+            # is rolled back too and the migration runs again on the next start
+            c.execute('BEGIN')
+            try:
+                c.execute("ALTER TABLE active_shifts ADD COLUMN clock_in_ts INTEGER")
+                # Backfill the epoch for shifts that were recorded before this column existed
+                for row in c.execute("SELECT user_id, clock_in FROM active_shifts").fetchall():
+                    try:
+                        clock_in_time = parse_timestamp(row['clock_in'])
+                    except (TypeError, ValueError):
+                        print(f"Warning: Corrupted clock-in string for user {row['user_id']}: '{row['clock_in']}'. Leaving clock_in_ts empty.")
+                        continue
+                    c.execute("UPDATE active_shifts SET clock_in_ts = ? WHERE user_id = ?", (int(clock_in_time.timestamp()), row['user_id']))
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            print("Migration complete.")
+
+        # Same for 'last_clockouts': 'timestamp_ts' holds the clock-out time as a Unix epoch for the cooldown check
+        try:
+            c.execute("SELECT timestamp_ts FROM last_clockouts LIMIT 1")
+        except sqlite3.OperationalError:
+            print("Migrating last_clockouts table: Adding 'timestamp_ts' column...")
+            c.execute('BEGIN') # One transaction for the column and its backfill, as above
+            try:
+                c.execute("ALTER TABLE last_clockouts ADD COLUMN timestamp_ts INTEGER")
+                for row in c.execute("SELECT user_id, timestamp FROM last_clockouts").fetchall():
+                    try:
+                        clock_out_time = parse_timestamp(row['timestamp'])
+                    except (TypeError, ValueError):
+                        print(f"Warning: Corrupted last_clockout timestamp for user {row['user_id']}: '{row['timestamp']}'. Leaving timestamp_ts empty.")
+                        continue
+                    c.execute("UPDATE last_clockouts SET timestamp_ts = ? WHERE user_id = ?", (int(clock_out_time.timestamp()), row['user_id']))
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            print("Migration complete.")
+        # --- End Migration Logic ---
+
+        # Index the clock-in epoch so the auto clock-out only visits expired shifts instead of scanning the table
+        # (created after the migrations, since older databases only gain the column above)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_active_shifts_clock_in_ts ON active_shifts (clock_in_ts)')
 
 # Initialize the database tables when the script starts
 init_db()
 
+def fetch_tuples(query, params=()):
+    """Runs a SELECT and returns its rows as plain tuples (cheaper to build and unpack than sqlite3.Row for bulk loads)."""
+    with db_lock:
+        cur = db_conn.cursor()
+        cur.row_factory = None # Overrides the connection's sqlite3.Row factory for this cursor only
+        return cur.execute(query, params).fetchall()
+
 # Functions for interacting with excluded_users table
 def load_excluded_users_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT user_id FROM excluded_users')
-    rows = c.fetchall()
-    conn.close()
-    return {row['user_id'] for row in rows} # Return a set for faster lookups
-
-def save_excluded_user_db(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('INSERT OR IGNORE INTO excluded_users (user_id) VALUES (?)', (user_id,))
-    conn.commit()
-    conn.close()
+    rows = fetch_tuples('SELECT user_id FROM excluded_users')
+    return {user_id for (user_id,) in rows} # Return a set for faster lookups
+
+def exclude_user_db(user_id):
+    """Adds the user to the excluded list and removes their active shift (if any) in a single transaction."""
+    with db_lock:
+        # The connection is in autocommit mode, so group both writes explicitly to commit once
+        db_conn.execute('BEGIN')
+        try:
+            db_conn.execute('INSERT OR IGNORE INTO excluded_users (user_id) VALUES (?)', (user_id,))
+            db_conn.execute('DELETE FROM active_shifts WHERE user_id = ?', (user_id,))
+            db_conn.execute('COMMIT')
+        except Exception:
+            db_conn.execute('ROLLBACK')
+            raise
 
 def remove_excluded_user_db(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM excluded_users WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    with db_lock:
+        db_conn.execute('DELETE FROM excluded_users WHERE user_id = ?', (user_id,))
 
 # Functions for interacting with active_shifts table
 def load_active_shifts_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Select guild_id along with user_id and clock_in
-    c.execute('SELECT user_id, clock_in, guild_id FROM active_shifts')
-    rows = c.fetchall()
-    conn.close()
-    # Store as {user_id: {'clock_in': clock_in_time_str, 'guild_id': guild_id}}
-    return {row['user_id']: {'clock_in': row['clock_in'], 'guild_id': row['guild_id']} for row in rows}
-
-def save_active_shift_db(user_id, clock_in, guild_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    # Insert or replace the shift, including guild_id
-    c.execute('INSERT OR REPLACE INTO active_shifts (user_id, clock_in, guild_id) VALUES (?, ?, ?)', (user_id, clock_in, guild_id))
-    conn.commit()
-    conn.close()
-
-def remove_active_shift_db(user_id):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('DELETE FROM active_shifts WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
+    # Only the epoch is kept in memory; the 'clock_in' text column is there for people reading the DB directly
+    rows = fetch_tuples('SELECT user_id, clock_in_ts, guild_id FROM active_shifts')
+    # Store as {user_id: {'clock_in_ts': epoch_seconds, 'guild_id': guild_id}}; display strings are derived from the epoch
+    return {user_id: {'clock_in_ts': clock_in_ts, 'guild_id': guild_id} for user_id, clock_in_ts, guild_id in rows}
+
+def save_active_shift_db(user_id, clock_in, clock_in_ts, guild_id, sheet_row=None):
+    """Saves the user's active shift and queues its Google Sheets row (if any) in a single transaction."""
+    with db_lock:
+        # The connection is in autocommit mode, so group both writes explicitly to commit once
+        db_conn.execute('BEGIN')
+        try:
+            # Insert the shift (or update it in place if one exists), including the epoch clock-in time and guild_id
+            db_conn.execute('INSERT INTO active_shifts (user_id, clock_in, clock_in_ts, guild_id) VALUES (?, ?, ?, ?) '
+                            'ON CONFLICT (user_id) DO UPDATE SET clock_in = excluded.clock_in, clock_in_ts = excluded.clock_in_ts, guild_id = excluded.guild_id', (user_id, clock_in, clock_in_ts, guild_id))
+            if sheet_row:
+                db_conn.execute('INSERT INTO sheet_queue (user_name, action, timestamp) VALUES (?, ?, ?)', sheet_row)
+            db_conn.execute('COMMIT')
+        except Exception:
+            db_conn.execute('ROLLBACK')
+            raise
 
 # Functions for interacting with last_clockouts table
 def load_last_clockouts_db():
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('SELECT user_id, timestamp FROM last_clockouts')
-    rows = c.fetchall()
-    conn.close()
-    return {row['user_id']: row['timestamp'] for row in rows} # Keys are integers, values are timestamp strings
-
-def save_last_clockout_db(user_id, timestamp):
-    conn = get_db_connection()
-    c = conn.cursor()
-    c.execute('INSERT OR REPLACE INTO last_clockouts (user_id, timestamp) VALUES (?, ?)', (user_id, timestamp))
-    conn.commit()
-    conn.close()
+    rows = fetch_tuples('SELECT user_id, timestamp_ts FROM last_clockouts')
+    return dict(rows) # Keys are integers, values are epoch seconds (None if corrupted)
+
+# Single clock-out used by the voice handler and the clock-out commands
+def clock_out_shift_db(user_id, timestamp, timestamp_ts, sheet_row=None):
+    """
+    Removes the user's active shift (if any), records their last clock-out time and queues the clock-out's
+    Google Sheets row (if any) in a single transaction.
+    """
+    with db_lock:
+        # The connection is in autocommit mode, so group the writes explicitly to commit once
+        db_conn.execute('BEGIN')
+        try:
+            db_conn.execute('DELETE FROM active_shifts WHERE user_id = ?', (user_id,))
+            db_conn.execute('INSERT INTO last_clockouts (user_id, timestamp, timestamp_ts) VALUES (?, ?, ?) '
+                            'ON CONFLICT (user_id) DO UPDATE SET timestamp = excluded.timestamp, timestamp_ts = excluded.timestamp_ts', (user_id, timestamp, timestamp_ts))
+            if sheet_row:
+                db_conn.execute('INSERT INTO sheet_queue (user_name, action, timestamp) VALUES (?, ?, ?)', sheet_row)
+            db_conn.execute('COMMIT')
+        except Exception:
+            db_conn.execute('ROLLBACK')
+            raise
+
+def load_earliest_clock_in_ts_db():
+    """Returns the epoch of the oldest active shift's clock-in, or None if there are no (datable) active shifts."""
+    with db_lock:
+        # MIN over the indexed clock_in_ts column reads a single index entry; NULL epochs are ignored
+        return db_conn.execute('SELECT MIN(clock_in_ts) FROM active_shifts').fetchone()[0]
+
+# Bulk clock-out used by the auto clock-out task
+def load_expired_shifts_db(cutoff_ts):
+    """Returns (user_id, guild_id) tuples for the active shifts that started at or before the `cutoff_ts` epoch."""
+    # Shifts with a NULL clock_in_ts (unparseable legacy clock-in) never match the comparison
+    return fetch_tuples('SELECT user_id, guild_id FROM active_shifts WHERE clock_in_ts <= ?', (cutoff_ts,))
+
+def expire_shifts_db(cutoff_ts, timestamp, timestamp_ts, sheet_rows):
+    """
+    Clocks out every active shift that started at or before the `cutoff_ts` epoch and queues their
+    Google Sheets rows in a single transaction.
+    """
+    with db_lock:
+        # The connection is in autocommit mode, so group the statements explicitly to commit once
+        db_conn.execute('BEGIN')
+        try:
+            # Set-based statements: SQLite records the clock-outs and removes the shifts without a per-row round trip
+            db_conn.execute('INSERT INTO last_clockouts (user_id, timestamp, timestamp_ts) SELECT user_id, ?, ? FROM active_shifts WHERE clock_in_ts <= ? '
+                            'ON CONFLICT (user_id) DO UPDATE SET timestamp = excluded.timestamp, timestamp_ts = excluded.timestamp_ts', (timestamp, timestamp_ts, cutoff_ts))
+            db_conn.execute('DELETE FROM active_shifts WHERE clock_in_ts <= ?', (cutoff_ts,))
+            db_conn.executemany('INSERT INTO sheet_queue (user_name, action, timestamp) VALUES (?, ?, ?)', sheet_rows)
+            db_conn.execute('COMMIT')
+        except Exception:
+            db_conn.execute('ROLLBACK')
+            raise
+
+# Functions for interacting with sheet_queue table
+def load_sheet_queue_db(limit):
+    """Returns up to `limit` (id, user_name, action, timestamp) tuples of queued Google Sheets rows, oldest first."""
+    return fetch_tuples('SELECT id, user_name, action, timestamp FROM sheet_queue ORDER BY id LIMIT ?', (limit,))
+
+def remove_sheet_rows_db(last_id):
+    """Removes the queued Google Sheets rows up to and including `last_id` once they have been written."""
+    with db_lock:
+        db_conn.execute('DELETE FROM sheet_queue WHERE id <= ?', (last_id,))
 
 # --- 3. Discord Bot Setup ---
 
@@ -147,9 +309,28 @@ intents = discord.Intents.default()
 intents.members = True # Required to get member info (names, IDs)
 intents.message_content = True # Required to read command messages
 intents.voice_states = True # Required for tracking voice channel activity (auto clock-in)
+intents.typing = False # Typing events are never used; skip decoding them on the gateway
+intents.presences = False # Presence updates are never used (and are the noisiest event on large guilds)
+
+class ClockBot(commands.Bot):
+    """commands.Bot that writes any queued Google Sheets rows before shutting down."""
+
+    async def setup_hook(self):
+        # Hosting platforms like Render stop the process with SIGTERM on every redeploy;
+        # close the bot instead of exiting immediately so close() below still runs
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            pass # Signal handlers aren't available on Windows event loops
+
+    async def close(self):
+        # Flush batch by batch until the queue is empty or a write fails, before the event loop is torn down
+        while await flush_sheet_rows():
+            pass
+        await super().close()
 
 # Initialize the bot with a command prefix and intents
-bot = commands.Bot(command_prefix='!', intents=intents)
+bot = ClockBot(command_prefix='!', intents=intents)
 
 # --- 4. Google Sheets Setup ---
 
@@ -160,13 +341,23 @@ scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/au
 # This environment variable (e.g., GOOGLE_CREDS) should contain the JSON key file content as a string.
 try:
     creds_json = json.loads(os.environ['GOOGLE_CREDS'])
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_json, scope)
-    client = gspread.authorize(creds)
-
-    # Open your specific Google Sheet by name
-    # IMPORTANT: Replace "Employee Time Log" with the exact name of your Google Sheet.
-    # Also, ensure the service account email has "Editor" access to this Google Sheet.
-    sheet = client.open("Employee Time Log").sheet1 # Assuming you want to interact with the first sheet
+    creds = Credentials.from_service_account_info(creds_json, scopes=scope)
+
+    # One authorized HTTP session for all Sheets traffic: keeps TLS connections alive between writes,
+    # refreshes the OAuth token only when it expires, and retries transient server errors
+    sheets_session = AuthorizedSession(creds)
+    sheets_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))))
+    client = gspread.Client(auth=creds, session=sheets_session)
+
+    # Open your specific Google Sheet once; the worksheet handle is reused for every write.
+    # Ensure the service account email has "Editor" access to this Google Sheet.
+    sheet_id = os.getenv('GOOGLE_SHEET_ID')
+    if sheet_id:
+        # Opening by key goes straight to the spreadsheet, skipping the Drive search that open-by-name needs
+        sheet = client.open_by_key(sheet_id).sheet1 # Assuming you want to interact with the first sheet
+    else:
+        # IMPORTANT: Replace "Employee Time Log" with the exact name of your Google Sheet (or set GOOGLE_SHEET_ID).
+        sheet = client.open("Employee Time Log").sheet1
 except KeyError:
     print("WARNING: GOOGLE_CREDS environment variable not found. Google Sheets functionality will be disabled.")
     sheet = None # Set sheet to None so subsequent calls will fail gracefully
@@ -174,16 +365,28 @@ except Exception as e:
     print(f"ERROR: Failed to connect to Google Sheets. Error: {e}")
     sheet = None
 
+# Rows waiting to be written to Google Sheets are queued in the sheet_queue table, in the same transaction as the
+# clock-in/out they belong to, so neither an outage nor a restart loses them. The `flush_pending_sheet_rows` task
+# writes them in bulk instead of one HTTPS call per event; rows from a failed append stay queued and are retried
+# (before any newer rows) with exponential backoff.
+SHEET_FLUSH_BATCH_SIZE = 500 # Maximum rows sent in a single append_rows call
+
+sheet_retry_delay = 0 # Current backoff in seconds (0 while writes are succeeding)
+sheet_retry_at = 0 # time.monotonic() value before which no retry is attempted
+SHEET_RETRY_BASE_DELAY = 5 # Seconds to wait after the first failure; doubled on each further failure
+SHEET_RETRY_MAX_DELAY = 300 # Never wait longer than 5 minutes between attempts
+sheet_write_lock = asyncio.Lock() # Serializes Google Sheets writes (see flush_sheet_rows)
+
+# Single worker thread for blocking gspread calls so they never run on the Discord event loop (only one write runs at a time anyway)
+sheets_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sheets')
+
 # --- 5. In-Memory Data Storage (Loaded from DB) ---
 
 # Load initial data into memory from SQLite database when the bot starts
 excluded_user_ids = load_excluded_users_db() # Set of user IDs who are excluded
-# Dictionary storing active shifts: {user_id: {'clock_in': 'timestamp_str', 'guild_id': guild_id}}
+# Dictionary storing active shifts: {user_id: {'clock_in_ts': epoch_seconds, 'guild_id': guild_id}}
 active_shifts = load_active_shifts_db()
-last_clockouts = load_last_clockouts_db() # Dictionary storing last clock-out times: {user_id: 'timestamp_str'}
-
-# Define the timezone for all time-related operations (e.g., Philippines)
-ph_tz = timezone('Asia/Manila')
+last_clockouts = load_last_clockouts_db() # Dictionary storing last clock-out times: {user_id: epoch_seconds}
 
 # --- 6. Bot Events (on_ready, on_voice_state_update) ---
 
@@ -191,16 +394,22 @@ ph_tz = timezone('Asia/Manila')
 async def on_ready():
     """Called when the bot successfully connects to Discord."""
     print(f'Bot is online as {bot.user.name} (ID: {bot.user.id})')
-    # Start the background task for auto-clocking out expired shifts
-    auto_clockout_expired_shifts.start()
-
-def can_clock_in(user_id):
+    # on_ready can fire again after a reconnect, so only start the background tasks once.
+    # They are started before the web server so a failure there can't keep them from running.
+    if not auto_clockout_expired_shifts.is_running():
+        # Start the background task for auto-clocking out expired shifts
+        auto_clockout_expired_shifts.start()
+    if not flush_pending_sheet_rows.is_running():
+        # Start the background task that writes queued rows to Google Sheets
+        flush_pending_sheet_rows.start()
+    # Start the keep-alive web server on the bot's event loop
+    await keep_alive()
+
+def can_clock_in(user_id, now_ts):
     """
-    Determines if a user is eligible for an automatic clock-in.
+    Determines if a user is eligible for an automatic clock-in at `now_ts` (epoch seconds, from the caller's clock read).
     Rules: Not in excluded list, no active shift, and not recently clocked out (cooldown period).
     """
-    now = datetime.now(ph_tz)
-
     if user_id in excluded_user_ids:
         return False # User is explicitly excluded from time tracking
 
@@ -208,52 +417,148 @@ def can_clock_in(user_id):
         return False # User already has an active shift recorded
 
     # Cooldown period: Prevent immediate re-clocking after a clock-out
-    cooldown_period = timedelta(minutes=5) # You can adjust this duration (e.g., 5 minutes)
-    last_out_str = last_clockouts.get(user_id) # Get the last clock-out timestamp string
+    last_out_ts = last_clockouts.get(user_id) # Epoch seconds of the last clock-out (None if unknown or corrupted)
 
-    if last_out_str: # If there's a record of a last clock-out
-        try:
-            # Convert the stored string timestamp back to a timezone-aware datetime object
-            last_out_time = ph_tz.localize(datetime.strptime(last_out_str, "%Y-%m-%d %H:%M:%S"))
-            if (now - last_out_time) < cooldown_period:
-                return False # Still within the cooldown period
-        except ValueError:
-            # Log an error if the stored timestamp string is corrupted, but don't block clock-in
-            print(f"Warning: Corrupted last_clockout timestamp for user {user_id}: '{last_out_str}'. Allowing clock-in.")
-            pass # Continue to allow clock-in if timestamp is unparseable
+    # Plain integer comparison, no timestamp parsing needed
+    if last_out_ts is not None and now_ts - last_out_ts < CLOCK_IN_COOLDOWN_SECONDS:
+        return False # Still within the cooldown period
 
     return True # All checks pass, the user is eligible to clock in
 
 # Helper function for logging to Google Sheets
-def log_to_google_sheets(user_name, action, timestamp_str):
+def make_sheet_row(user_name, action, timestamp_str):
+    """
+    Returns the Google Sheets row for a clock event, to be queued by the DB helper that records the event.
+    Returns None if Sheets is not configured.
+    """
     if sheet:
+        print(f"Queued {action} for {user_name} at {timestamp_str}")
+        return (user_name, action, timestamp_str)
+    else:
+        print(f"Skipped logging {action} for {user_name} due to Google Sheets not being configured.")
+        return None
+
+def sheets_retry_after(error):
+    """Returns the Retry-After delay (in seconds) of a rate-limited (429) Sheets API error, or 0 if there isn't one."""
+    if not isinstance(error, gspread.exceptions.APIError) or error.response.status_code != 429:
+        return 0
+    try:
+        return float(error.response.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0 # Retry-After given as an HTTP date; fall back to the normal backoff
+
+async def flush_sheet_rows():
+    """
+    Appends the oldest queued rows, at most SHEET_FLUSH_BATCH_SIZE, to Google Sheets in one call and removes them
+    from the queue once written. Returns True if a batch was written. On failure the rows stay queued and are retried
+    later with exponential backoff.
+    """
+    global sheet_retry_delay, sheet_retry_at
+
+    # Only one append may be in flight at a time (the flush loop and bot.close() can both call this),
+    # which keeps rows in order and the write rate at no more than one request per flush
+    async with sheet_write_lock:
+        if not sheet or time.monotonic() < sheet_retry_at:
+            return False # Sheets isn't configured, or we're still backing off after a failed write
+
+        # Oldest rows first (including any from a failed append) so rows reach the sheet in the order they happened;
+        # the batch size caps a single request however long an outage lasted, and the rest stay queued
+        queued = await run_db(load_sheet_queue_db, SHEET_FLUSH_BATCH_SIZE)
+        if not queued:
+            return False
+        batch = [[user_name, action, timestamp] for _, user_name, action, timestamp in queued]
+
         try:
-            sheet.append_row([user_name, action, timestamp_str])
-            print(f"Logged {action} for {user_name} at {timestamp_str}")
-            return True
+            # append_rows is a blocking HTTPS call, so run it on the Sheets executor to keep the event loop free
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(sheets_executor, partial(sheet.append_rows, batch, value_input_option='RAW', insert_data_option='INSERT_ROWS'))
         except Exception as e:
-            print(f"Failed to append {action} to Google Sheets for {user_name}: {e}")
+            # Leave the rows queued and back off before retrying (longer if Google asked us to wait).
+            # While backing off no request is attempted and new rows just wait in the queue.
+            first_failure = sheet_retry_delay == 0
+            sheet_retry_delay = min(max(sheet_retry_delay * 2, SHEET_RETRY_BASE_DELAY), SHEET_RETRY_MAX_DELAY)
+            wait = max(sheet_retry_delay, sheets_retry_after(e))
+            sheet_retry_at = time.monotonic() + wait
+            # Log when writes start failing, not on every retry of the same outage
+            if first_failure:
+                print(f"Failed to append {len(batch)} row(s) to Google Sheets: {e}. Holding rows and retrying with backoff (first retry in {wait:g}s).")
             return False
-    else:
-        print(f"Skipped logging {action} for {user_name} due to Google Sheets not being configured.")
-        return False
+
+        # Only drop the rows once Google has them (if the bot stops before this, they are sent again on the next start)
+        await run_db(remove_sheet_rows_db, queued[-1][0])
+        if sheet_retry_delay:
+            print(f"Google Sheets writes recovered; flushed {len(batch)} row(s).")
+        else:
+            print(f"Flushed {len(batch)} row(s) to Google Sheets.")
+        sheet_retry_delay = 0
+        return True
+
+# Cache of the channel used for notifications in each guild: {guild_id: channel_id}
+# Resolved on first use and cleared whenever the guild's channels or system channel change.
+notification_channels = {}
+
+def get_notification_channel(guild):
+    """Returns the guild's notification channel, resolving it only when it isn't cached yet."""
+    channel_id = notification_channels.get(guild.id)
+    channel = guild.get_channel(channel_id) if channel_id else None
+    if channel is None:
+        # Try system channel, then 'general', then the first text channel, skipping any the bot can't post in
+        me = guild.me
+        channel = guild.system_channel
+        if channel is not None and not channel.permissions_for(me).send_messages:
+            channel = None
+        if channel is None:
+            # One pass over the text channels finds both 'general' and the first sendable fallback
+            fallback = None
+            for text_channel in guild.text_channels:
+                if not text_channel.permissions_for(me).send_messages:
+                    continue
+                if text_channel.name == 'general':
+                    channel = text_channel
+                    break
+                if fallback is None:
+                    fallback = text_channel
+            channel = channel or fallback
+        if channel:
+            notification_channels[guild.id] = channel.id
+    return channel
 
 # Helper function to send notification messages
 async def send_notification(member, message):
     if not member or not member.guild:
         return
 
-    # Try system channel, then 'general', then any available text channel
-    channel_to_send = member.guild.system_channel or \
-                      discord.utils.get(member.guild.text_channels, name='general') or \
-                      (member.guild.text_channels[0] if member.guild.text_channels else None)
+    channel_to_send = get_notification_channel(member.guild)
 
     if channel_to_send:
         try:
             await channel_to_send.send(message)
         except discord.Forbidden:
+            # Permissions changed since the channel was cached (e.g. a role edit); resolve it again next time
+            notification_channels.pop(member.guild.id, None)
             print(f"Cannot send message to {channel_to_send.name} in {member.guild.name} (Forbidden: Bot lacks permissions).")
 
+@bot.event
+async def on_guild_channel_create(channel):
+    """A new channel (e.g. 'general') may change which channel notifications should go to."""
+    notification_channels.pop(channel.guild.id, None)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Drops the cached notification channel in case it was the one deleted."""
+    notification_channels.pop(channel.guild.id, None)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    """Renames or position changes can change which channel is 'general' or first."""
+    notification_channels.pop(after.guild.id, None)
+
+@bot.event
+async def on_guild_update(before, after):
+    """The guild's system channel may have changed."""
+    if before.system_channel != after.system_channel:
+        notification_channels.pop(after.id, None)
+
 @bot.event
 async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
     """
@@ -264,25 +569,43 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
     if member.bot:
         return # Ignore actions by other bots
 
+    # Most voice updates (server mute, streaming, video, etc.) change neither the channel nor the
+    # self-mute/deafen state that drive clocking, so skip them before doing any other work
+    if before.channel == after.channel and before.self_mute == after.self_mute and before.self_deaf == after.self_deaf:
+        return
+
     user_id = member.id
-    guild_id = member.guild.id
-    now = datetime.now(ph_tz)
-    timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
 
     # Ignore actions by users in the excluded list
     if user_id in excluded_user_ids:
         return
 
+    # Clocking only happens when the user's on-duty state (in a channel, not muted/deafened) disagrees with
+    # whether they have an active shift. Most events (e.g. a clocked-in user moving channels or re-joining)
+    # don't, so they return here with two in-memory checks and no clock reads or DB work.
+    on_duty = after.channel is not None and not after.self_deaf and not after.self_mute
+    if on_duty == (user_id in active_shifts):
+        return
+
+    guild_id = member.guild.id
+    now = datetime.now(ph_tz)
+    now_ts = int(now.timestamp()) # Epoch seconds stored for shifts and clock-outs
+    timestamp_str = format_timestamp(now)
+
     # Case 1: User joins a voice channel or moves between channels
     if after.channel and not before.channel:
         # Check if they are not muted or deafened, and are eligible to clock in
-        if not after.self_deaf and not after.self_mute and can_clock_in(user_id):
+        if not after.self_deaf and not after.self_mute and can_clock_in(user_id, now_ts):
             print(f"Attempting to clock in {member.name} due to joining a voice channel.")
             # Record the clock-in time and the guild ID
-            active_shifts[user_id] = {'clock_in': timestamp_str, 'guild_id': guild_id}
-            save_active_shift_db(user_id, timestamp_str, guild_id)
-            if log_to_google_sheets(member.name, "Clock In (Auto)", timestamp_str):
+            active_shifts[user_id] = {'clock_in_ts': now_ts, 'guild_id': guild_id}
+            sheet_row = make_sheet_row(member.name, "Clock In (Auto)", timestamp_str)
+            await run_db(save_active_shift_db, user_id, timestamp_str, now_ts, guild_id, sheet_row) # Shift and Sheets row in one transaction
+            if sheet_row:
                 await send_notification(member, f"✅ {member.mention} has automatically clocked in (joined voice channel).")
+        elif not after.self_deaf and not after.self_mute and user_id not in active_shifts:
+            # Not muted, not excluded (checked above) and no active shift, so only the cooldown can have failed
+            print(f"Skipping auto clock-in for {member.name}. Reason: Clocked out too recently (cooldown).")
         else:
             print(f"Skipping auto clock-in for {member.name}. Reason: Muted/deafened or not eligible.")
 
@@ -291,43 +614,42 @@ async def on_voice_state_update(member: discord.Member, before: discord.VoiceSta
         # If the user had an active shift recorded by the bot
         if user_id in active_shifts:
             print(f"Attempting to clock out {member.name} due to leaving a voice channel.")
-            # Log the clock-out event
-            log_to_google_sheets(member.name, "Clock Out (Auto)", timestamp_str)
-            # Remove the shift from memory and DB
+            # Remove the shift, update the last clockout time for cooldown and log the clock-out event (one DB transaction)
             del active_shifts[user_id]
-            remove_active_shift_db(user_id)
-            # Update the last clockout time for cooldown
-            last_clockouts[user_id] = timestamp_str
-            save_last_clockout_db(user_id, timestamp_str)
+            last_clockouts[user_id] = now_ts
+            await run_db(clock_out_shift_db, user_id, timestamp_str, now_ts, make_sheet_row(member.name, "Clock Out (Auto)", timestamp_str))
             await send_notification(member, f"🛑 {member.mention} has automatically clocked out (left voice channel).")
     
     # Case 3: User Mutes/Deafens themselves while in a channel (considered 'not on duty')
     elif after.channel and (after.self_deaf or after.self_mute) and (not before.self_deaf and not before.self_mute):
         if user_id in active_shifts:
             print(f"Attempting to clock out {member.name} due to muting/deafening.")
-            # Log the clock-out event
-            log_to_google_sheets(member.name, "Clock Out (Auto)", timestamp_str)
-            # Remove the shift from memory and DB
+            # Remove the shift, update the last clockout time for cooldown and log the clock-out event (one DB transaction)
             del active_shifts[user_id]
-            remove_active_shift_db(user_id)
-            # Update the last clockout time for cooldown
-            last_clockouts[user_id] = timestamp_str
-            save_last_clockout_db(user_id, timestamp_str)
+            last_clockouts[user_id] = now_ts
+            await run_db(clock_out_shift_db, user_id, timestamp_str, now_ts, make_sheet_row(member.name, "Clock Out (Auto)", timestamp_str))
             await send_notification(member, f"🛑 {member.mention} has automatically clocked out (muted/deafened).")
     
     # Case 4: User Unmutes/Undeafens themselves while in a channel (considered 'on duty')
     elif after.channel and (not after.self_deaf and not after.self_mute) and (before.self_deaf or before.self_mute):
-        if can_clock_in(user_id):
+        if can_clock_in(user_id, now_ts):
             print(f"Attempting to clock in {member.name} due to unmuting/undeafening.")
             # Record the clock-in time and the guild ID
-            active_shifts[user_id] = {'clock_in': timestamp_str, 'guild_id': guild_id}
-            save_active_shift_db(user_id, timestamp_str, guild_id)
-            if log_to_google_sheets(member.name, "Clock In (Auto)", timestamp_str):
+            active_shifts[user_id] = {'clock_in_ts': now_ts, 'guild_id': guild_id}
+            sheet_row = make_sheet_row(member.name, "Clock In (Auto)", timestamp_str)
+            await run_db(save_active_shift_db, user_id, timestamp_str, now_ts, guild_id, sheet_row) # Shift and Sheets row in one transaction
+            if sheet_row:
                 await send_notification(member, f"✅ {member.mention} has automatically clocked in (unmuted/undeafened).")
 
 
 # --- 7. Discord Bot Commands ---
 
+def find_member_by_name(guild, username):
+    """Returns the first member of the guild whose username matches (case-insensitive), or None if there is no match."""
+    name = username.lower() # Lowercase the query once instead of on every comparison
+    # Stop at the first match instead of building a list of every matching member
+    return next((m for m in guild.members if m.name.lower() == name), None)
+
 # ========== Admin Commands (Require Administrator Permissions) ==========
 
 @bot.command()
@@ -342,11 +664,10 @@ async def clockin(ctx, member: discord.Member = None, *, username: str = None):
         target_user = member
     elif username: # If a username string is provided
         # Search for member by username (case-insensitive) in the current guild
-        found_members = [m for m in ctx.guild.members if m.name.lower() == username.lower()]
-        if not found_members:
+        target_user = find_member_by_name(ctx.guild, username)
+        if target_user is None:
             await ctx.send(f'❌ No user found with username "{username}". Please mention the user or provide exact username.')
             return
-        target_user = found_members[0] # Take the first match
     else: # If no user is specified, assume the command issuer (admin)
         target_user = ctx.author
 
@@ -358,7 +679,10 @@ async def clockin(ctx, member: discord.Member = None, *, username: str = None):
         await ctx.send(f"❌ {target_user.mention} is excluded from time tracking and cannot be clocked in.")
         return
 
-    if not can_clock_in(user_id):
+    now = datetime.now(ph_tz) # Read the clock once for the eligibility check and the stored times
+    now_ts = int(now.timestamp())
+
+    if not can_clock_in(user_id, now_ts):
         # Provide specific feedback if they cannot clock in due to existing shift or cooldown
         if target_user == ctx.author:
             await ctx.send(f"⚠️ {ctx.author.mention}, you cannot clock in at this time. You might already be clocked in, or have clocked out too recently. If you wish to end your current shift, use `!clockout` (if applicable).")
@@ -366,17 +690,17 @@ async def clockin(ctx, member: discord.Member = None, *, username: str = None):
             await ctx.send(f"⚠️ {target_user.mention} cannot be clocked in at this time. They might already be clocked in, or have clocked out too recently.")
         return
 
-    now = datetime.now(ph_tz)
-    timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    timestamp_str = format_timestamp(now)
 
     # Try to log to Google Sheets first
-    if not log_to_google_sheets(target_name, "Clock In", timestamp_str):
+    sheet_row = make_sheet_row(target_name, "Clock In", timestamp_str)
+    if not sheet_row:
         await ctx.send(f"❌ Failed to log {target_name}'s clock-in to Google Sheets. Please contact an admin.")
         return # Stop execution if Google Sheet logging fails
 
-    # Store the active shift in memory and persist to DB
-    active_shifts[user_id] = {'clock_in': timestamp_str, 'guild_id': guild_id}
-    save_active_shift_db(user_id, timestamp_str, guild_id)
+    # Store the active shift in memory and persist it to DB together with its Sheets row
+    active_shifts[user_id] = {'clock_in_ts': now_ts, 'guild_id': guild_id}
+    await run_db(save_active_shift_db, user_id, timestamp_str, now_ts, guild_id, sheet_row)
 
     # Confirm the action to the user who issued the command
     if target_user == ctx.author:
@@ -398,12 +722,12 @@ async def exclude(ctx, member: discord.Member = None, *, username: str = None):
         target_user_id = member.id
         target_user_name = member.name
     elif username:
-        found_members = [m for m in ctx.guild.members if m.name.lower() == username.lower()]
-        if not found_members:
+        found_member = find_member_by_name(ctx.guild, username)
+        if found_member is None:
             await ctx.send(f'❌ No user found with username "{username}". Please mention the user or provide exact username.')
             return
-        target_user_id = found_members[0].id
-        target_user_name = found_members[0].name
+        target_user_id = found_member.id
+        target_user_name = found_member.name
     else:
         await ctx.send("❌ Please mention a user or provide a username to exclude.")
         return
@@ -412,13 +736,10 @@ async def exclude(ctx, member: discord.Member = None, *, username: str = None):
         await ctx.send(f"⚠️ {target_user_name} is already excluded.")
         return
 
-    save_excluded_user_db(target_user_id) # Persist to DB
+    # Update memory before awaiting the DB write, so voice events handled in the meantime already see the exclusion
     excluded_user_ids.add(target_user_id) # Add to in-memory set
-
-    # If the excluded user currently has an active shift, end it
-    if target_user_id in active_shifts:
-        del active_shifts[target_user_id]
-        remove_active_shift_db(target_user_id) # Remove from DB
+    active_shifts.pop(target_user_id, None) # If the excluded user had an active shift, end it
+    await run_db(exclude_user_db, target_user_id) # Persist both changes in one transaction
 
     await ctx.send(f"✅ {target_user_name} has been excluded from time tracking.")
 
@@ -436,12 +757,12 @@ async def include(ctx, member: discord.Member = None, *, username: str = None):
         target_user_id = member.id
         target_user_name = member.name
     elif username:
-        found_members = [m for m in ctx.guild.members if m.name.lower() == username.lower()]
-        if not found_members:
+        found_member = find_member_by_name(ctx.guild, username)
+        if found_member is None:
             await ctx.send(f'❌ No user found with username "{username}". Please mention the user or provide exact username.')
             return
-        target_user_id = found_members[0].id
-        target_user_name = found_members[0].name
+        target_user_id = found_member.id
+        target_user_name = found_member.name
     else:
         await ctx.send("❌ Please mention a user or provide a username to include.")
         return
@@ -450,8 +771,8 @@ async def include(ctx, member: discord.Member = None, *, username: str = None):
         await ctx.send(f"⚠️ {target_user_name} is not currently excluded.")
         return
 
-    remove_excluded_user_db(target_user_id) # Remove from DB
     excluded_user_ids.remove(target_user_id) # Remove from in-memory set
+    await run_db(remove_excluded_user_db, target_user_id) # Remove from DB
 
     await ctx.send(f"✅ {target_user_name} has been included back in time tracking.")
 
@@ -466,13 +787,12 @@ async def listexcluded(ctx):
         await ctx.send("ℹ️ No users are currently excluded from time tracking.")
         return
 
-    excluded_names = []
-    for uid in excluded_user_ids:
-        user = bot.get_user(uid) # Get the Discord user object
-        if user:
-            excluded_names.append(user.name)
-        else:
-            excluded_names.append(f"Unknown User (ID: {uid})") # Fallback if user object not found
+    # Snapshot {uid: user} in one pass, then build the names from it. Look in this guild's member cache first;
+    # exclusions apply across every server, so fall back to the global user cache for users who aren't members here.
+    get_member = ctx.guild.get_member
+    get_user = bot.get_user
+    users = {uid: get_member(uid) or get_user(uid) for uid in excluded_user_ids}
+    excluded_names = [user.name if user else f"Unknown User (ID: {uid})" for uid, user in users.items()] # Fallback if user object not found
 
     await ctx.send("🚫 **Excluded users:**\n" + "\n".join(excluded_names))
 
@@ -484,23 +804,19 @@ async def onduty(ctx):
     Includes User IDs for debugging purposes.
     Usage: !onduty
     """
-    guild_id = ctx.guild.id # Get the ID of the guild where the command was issued
-    on_duty_in_guild = {} # Dictionary to store active shifts relevant to this guild
-
-    # Filter active_shifts to only include entries from the current guild
-    for uid, shift_info in active_shifts.items():
-        # Only include if guild_id matches AND guild_id is not NULL/None (for older entries)
-        if shift_info.get('guild_id') == guild_id and shift_info.get('guild_id') is not None:
-            on_duty_in_guild[uid] = shift_info['clock_in']
+    # Read the in-memory shifts, which are updated before any DB write, so no DB round trip is needed
+    # (older entries with a NULL guild_id never match)
+    on_duty_in_guild = {uid: info['clock_in_ts'] for uid, info in active_shifts.items() if info['guild_id'] == ctx.guild.id} # {user_id: clock_in_ts}
 
     if not on_duty_in_guild:
         await ctx.send("ℹ️ No users are currently on duty in this server.")
         return
 
     msg = "✅ **Currently on duty in this server:**\n"
-    for uid, clock_in_str in on_duty_in_guild.items():
+    for uid, clock_in_ts in on_duty_in_guild.items():
         user = ctx.guild.get_member(uid) # Try to get member from *current guild*
         name = user.display_name if user else f"Unknown User (ID: {uid})" # Use display_name, fallback if not found
+        clock_in_str = format_timestamp(datetime.fromtimestamp(clock_in_ts, ph_tz)) if clock_in_ts is not None else "an unknown time"
         # IMPORTANT: This line now includes the `uid` for debugging.
         msg += f"- {name} (ID: `{uid}`) clocked in at {clock_in_str}\n"
     await ctx.send(msg)
@@ -516,24 +832,25 @@ async def forceclockout(ctx, member: discord.Member):
     user_name = member.name # Display name for logging
 
     now = datetime.now(ph_tz)
-    timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    now_ts = int(now.timestamp())
+    timestamp_str = format_timestamp(now)
 
     # Check if the user was considered active by the bot before processing
     was_active = user_id in active_shifts
 
     # Log the force clock-out to Google Sheets
-    if not log_to_google_sheets(user_name, "Clock Out (Force)", timestamp_str):
+    sheet_row = make_sheet_row(user_name, "Clock Out (Force)", timestamp_str)
+    if not sheet_row:
         await ctx.send(f"❌ Failed to log force clock-out to Google Sheets. Please contact an admin.")
         return # Stop execution if Google Sheet logging fails
 
-    # If they were active, remove their shift from active_shifts and DB
+    # If they were active, remove their shift from active_shifts
     if was_active:
         del active_shifts[user_id]
-        remove_active_shift_db(user_id)
 
     # Update last_clockouts regardless (important for cooldown on subsequent clock-ins)
-    last_clockouts[user_id] = timestamp_str
-    save_last_clockout_db(user_id, timestamp_str)
+    last_clockouts[user_id] = now_ts
+    await run_db(clock_out_shift_db, user_id, timestamp_str, now_ts, sheet_row) # Removes any shift row, records the clock-out and queues the Sheets row in one transaction
 
     # Confirm the action to the admin and indicate previous status
     if was_active:
@@ -557,24 +874,25 @@ async def clockout(ctx):
         return
 
     now = datetime.now(ph_tz)
-    timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
+    now_ts = int(now.timestamp())
+    timestamp_str = format_timestamp(now)
 
     # Check if the user was considered active by the bot before processing
     was_active = user_id in active_shifts
 
     # Log the manual clock-out to Google Sheets
-    if not log_to_google_sheets(user_name, "Clock Out", timestamp_str):
+    sheet_row = make_sheet_row(user_name, "Clock Out", timestamp_str)
+    if not sheet_row:
         await ctx.send(f"❌ Failed to log your clock-out to Google Sheets. Please contact an admin.")
         return # Stop execution if Google Sheet logging fails
 
-    # If they were active, remove their shift from active_shifts and DB
+    # If they were active, remove their shift from active_shifts
     if was_active:
         del active_shifts[user_id]
-        remove_active_shift_db(user_id)
 
     # Update last_clockouts regardless, as a successful clock-out (manual or auto) updates this
-    last_clockouts[user_id] = timestamp_str
-    save_last_clockout_db(user_id, timestamp_str)
+    last_clockouts[user_id] = now_ts
+    await run_db(clock_out_shift_db, user_id, timestamp_str, now_ts, sheet_row) # Removes any shift row, records the clock-out and queues the Sheets row in one transaction
 
     # Provide a flexible response based on if they were actively clocked in
     if was_active:
@@ -596,32 +914,27 @@ async def status(ctx):
 
     if user_id in active_shifts:
         # User is clocked in
-        shift_info = active_shifts[user_id]
-        clock_in_str = shift_info['clock_in']
+        clock_in_ts = active_shifts[user_id]['clock_in_ts']
 
-        try:
-            # Convert stored string to a timezone-aware datetime object
-            clock_in_time = ph_tz.localize(datetime.strptime(clock_in_str, "%Y-%m-%d %H:%M:%S"))
-            # Format the datetime for a user-friendly display
-            display_time = clock_in_time.strftime("%I:%M %p on %B %d, %Y")
+        if clock_in_ts is not None:
+            # Format the epoch for a user-friendly display
+            display_time = datetime.fromtimestamp(clock_in_ts, ph_tz).strftime(DISPLAY_TIME_FORMAT)
             await ctx.send(f"🟢 {ctx.author.mention}, you are currently **Clocked In** since {display_time}.")
-        except ValueError:
-            # Handle cases where the stored datetime string might be malformed
+        else:
+            # The stored clock-in string could not be converted to an epoch during migration
             await ctx.send(f"⚠️ {ctx.author.mention}, your clock-in time data is corrupted. Please contact an administrator.")
-            print(f"Error parsing clock_in_time for user {user_id}: {clock_in_str}")
+            print(f"Missing clock_in_ts for user {user_id}.")
     else:
         # User is clocked out
-        last_out_str = last_clockouts.get(user_id)
-        if last_out_str:
+        if user_id in last_clockouts:
+            last_out_ts = last_clockouts[user_id]
             # Show their last clock-out time if available
-            try:
-                last_out_time = ph_tz.localize(datetime.strptime(last_out_str, "%Y-%m-%d %H:%M:%S"))
-                display_time = last_out_time.strftime("%I:%M %p on %B %d, %Y")
+            if last_out_ts is not None:
+                display_time = datetime.fromtimestamp(last_out_ts, ph_tz).strftime(DISPLAY_TIME_FORMAT)
                 await ctx.send(f"🔴 {ctx.author.mention}, you are currently **Clocked Out**. Your last recorded clock-out was at {display_time}.")
-            except ValueError:
-                    # Handle cases where the last clock-out string might be malformed
-                    await ctx.send(f"🔴 {ctx.author.mention}, you are currently **Clocked Out**. (Last clock-out time data unavailable or corrupted.)")
-                    print(f"Error parsing last_out_time for user {user_id}: {last_out_str}")
+            else:
+                # The stored clock-out time could not be converted to an epoch during migration
+                await ctx.send(f"🔴 {ctx.author.mention}, you are currently **Clocked Out**. (Last clock-out time data unavailable or corrupted.)")
         else:
             # No clock-in or clock-out records found for the user at all
             await ctx.send(f"🔴 {ctx.author.mention}, you are currently **Clocked Out**. (No previous clock-in/out records found.)")
@@ -638,77 +951,92 @@ async def myid(ctx):
 
 # --- 8. Background Task: Auto Clock-out Expired Shifts ---
 
-@tasks.loop(minutes=15) # This task runs every 15 minutes
+@tasks.loop() # No fixed interval: each iteration sleeps until the next shift is due to expire
 async def auto_clockout_expired_shifts():
+    """
+    Waits until the oldest active shift reaches the maximum duration (14 hours), then clocks out every expired shift.
+    Shifts always start "now", so a new clock-in can never expire before the shift this iteration is waiting on;
+    if there are no active shifts it waits a full shift length and checks again.
+    """
+    earliest_ts = await run_db(load_earliest_clock_in_ts_db)
+    next_expiry_ts = (earliest_ts if earliest_ts is not None else time.time()) + MAX_SHIFT_DURATION_SECONDS
+    # +1s so the integer cutoff computed after waking is guaranteed to include that shift
+    await asyncio.sleep(max(0, next_expiry_ts - time.time() + 1))
+    await clock_out_expired_shifts()
+
+async def clock_out_expired_shifts():
     """
     Automatically clocks out users whose shifts have exceeded a maximum duration (e.g., 14 hours).
     Prevents shifts from running indefinitely if a manual clock-out is missed.
     """
-    print(f"Running auto_clockout_expired_shifts task at {datetime.now(ph_tz).strftime('%Y-%m-%d %H:%M:%S')}...")
     now = datetime.now(ph_tz)
-    expired = [] # List to hold user IDs of shifts that need to be expired
+    now_ts = int(now.timestamp())
+    timestamp_str = format_timestamp(now) # Same timestamp for every shift expired in this run
+    print(f"Running auto clock-out of expired shifts at {timestamp_str}...")
+    cutoff_ts = now_ts - MAX_SHIFT_DURATION_SECONDS # Shifts that started at or before this have exceeded 14 hours
+    notify_members = [] # Members to notify once all expired shifts have been processed
+    sheet_rows = [] # Google Sheets rows, queued together with the clock-outs
+
+    # Let SQLite find the expired shifts through the clock_in_ts index instead of checking every active shift in Python
+    expired = await run_db(load_expired_shifts_db, cutoff_ts)
+    if not expired:
+        return
+
+    # Guild IDs can be None for old entries
+    for uid, guild_id in expired:
+        # End the shift in memory first. A user who was clocked out elsewhere (e.g. left voice) while the
+        # DB call was running is no longer in active_shifts and has already been logged, so skip them.
+        if active_shifts.pop(uid, None) is None:
+            continue
+        last_clockouts[uid] = now_ts # Update last_clockouts for cooldown purposes
+
+        # Resolve the member directly from the guild recorded at clock-in (both are O(1) cache lookups)
+        guild = bot.get_guild(guild_id) if guild_id else None
+        member = guild.get_member(uid) if guild else None
+        user = member or bot.get_user(uid) # Fall back to the global user cache for the name
+        name = user.name if user else f"User ID: {uid}" # Fallback name if user object not found
+
+        # Log the auto clock-out event to Google Sheets
+        sheet_row = make_sheet_row(name, "Clock Out (Auto)", timestamp_str)
+        if sheet_row:
+            sheet_rows.append(sheet_row)
+
+        # Attempt to send a notification message to the user in the guild they clocked in from
+        if member:
+            notify_members.append(member)
+        elif not guild_id: # Older entries where guild_id is NULL
+            print(f"No guild recorded for user {name} (ID: {uid}); skipping auto clock-out notification.")
+        elif not guild:
+            print(f"Could not find Discord guild for ID {guild_id} for auto clock-out notification for user {name}.")
+        else:
+            print(f"User {name} (ID: {uid}) not found as member in guild {guild.name} (ID: {guild_id}) for auto clock-out notification.")
 
-    # Iterate over a copy of active_shifts because we'll be modifying the original dictionary
-    for uid, shift_info in list(active_shifts.items()):
-        clock_in_str = shift_info['clock_in']
-        guild_id = shift_info.get('guild_id') # Safely get guild_id (can be None from old entries)
+    # Clock out the expired shifts and queue their rows in one transaction (shifts ended elsewhere in the
+    # meantime were already removed from the DB by their own, earlier submitted, write)
+    await run_db(expire_shifts_db, cutoff_ts, timestamp_str, now_ts, sheet_rows)
 
-        try:
-            # Convert the stored clock-in string to a timezone-aware datetime object
-            clock_in_time = ph_tz.localize(datetime.strptime(clock_in_str, "%Y-%m-%d %H:%M:%S"))
-        except ValueError:
-            print(f"Warning: Corrupted clock-in string for user {uid}: '{clock_in_str}'. Skipping auto-clockout for this user.")
-            continue # Skip this user if the time string is unparseable
-
-        # Check if the shift duration has exceeded 14 hours
-        if now - clock_in_time >= timedelta(hours=14):
-            user = bot.get_user(uid) # Get the Discord user object
-            name = user.name if user else f"User ID: {uid}" # Fallback name if user object not found
-            timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S")
-
-            # Log the auto clock-out event to Google Sheets
-            log_to_google_sheets(name, "Clock Out (Auto)", timestamp_str)
-
-            # Update last_clockouts for cooldown purposes and persist
-            last_clockouts[uid] = timestamp_str
-            save_last_clockout_db(uid, timestamp_str)
-
-            expired.append(uid) # Add user ID to the list of expired shifts
-
-            # Attempt to send a notification message to the user in a relevant channel
-            if user:
-                if guild_id: # If we know the specific guild they clocked in from (preferred)
-                    guild = bot.get_guild(guild_id)
-                    if guild:
-                        member = guild.get_member(uid) # Get guild-specific member object
-                        if member:
-                            await send_notification(member, f"⚠️ {user.mention} was automatically clocked out after 14 hours. Please remember to `!clockout` manually at the end of your shift.")
-                        else:
-                            print(f"User {user.name} (ID: {uid}) not found as member in guild {guild.name} (ID: {guild_id}) for auto clock-out notification.")
-                    else:
-                        print(f"Could not find Discord guild for ID {guild_id} for auto clock-out notification for user {name}.")
-                else: # Fallback for older entries where guild_id might be NULL
-                    found_guild_for_message = False
-                    for guild_in_bot in bot.guilds:
-                        member_in_guild = guild_in_bot.get_member(uid)
-                        if member_in_guild:
-                            await send_notification(member_in_guild, f"⚠️ {user.mention} was automatically clocked out after 14 hours. Please remember to `!clockout` manually at the end of your shift.")
-                            found_guild_for_message = True
-                            break # Only send to one guild if not specific
-                    if not found_guild_for_message:
-                        print(f"Could not find a guild to send auto clock-out notification for user {name} (ID: {uid}) with missing guild_id.")
-            else:
-                print(f"Could not find Discord user object for ID {uid} for auto clock-out notification.")
+    # Send all notifications concurrently instead of waiting on each channel.send in turn
+    results = await asyncio.gather(
+        *(send_notification(member, f"⚠️ {member.mention} was automatically clocked out after 14 hours. Please remember to `!clockout` manually at the end of your shift.") for member in notify_members),
+        return_exceptions=True
+    )
+    for member, result in zip(notify_members, results):
+        if isinstance(result, Exception):
+            print(f"Failed to send auto clock-out notification for {member.name} (ID: {member.id}): {result}")
 
-    # After iterating through all shifts, remove the expired ones from memory and DB
-    for uid in expired:
-        del active_shifts[uid]
-        remove_active_shift_db(uid)
+# --- 9. Background Task: Flush Queued Google Sheets Rows ---
+
+@tasks.loop(seconds=5) # This task runs every 5 seconds
+async def flush_pending_sheet_rows():
+    """
+    Writes queued clock-in/out rows to Google Sheets in a single append_rows call.
+    Collapses bursts of voice events into one API request and keeps blocking I/O off the event loop.
+    """
+    await flush_sheet_rows()
 
-# --- 9. Bot Startup ---
+# --- 10. Bot Startup ---
 
 if __name__ == '__main__':
-    keep_alive() # Start the Flask web server in a separate thread
     # Run the Discord bot using your token from environment variables
     # The DISCORD_TOKEN environment variable MUST be set.
     bot.run(os.environ['DISCORD_TOKEN'])